@@ -1,28 +1,66 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import argparse
+import asyncio
+import aiohttp
+import re
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from rdkit import Chem
-from rdkit.Chem import AllChem, Draw
-from rdkit import DataStructs
+from rdkit.Chem import Draw, rdFingerprintGenerator
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+import numpy as np
 import csv
+import sqlite3
 import time
 from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 import logging
 
+try:
+    from numba import njit, prange, types
+    from numba.extending import intrinsic
+except ImportError:
+    njit = None
+
 # === Configurable parameters (CLI will override these) ===
 DEFAULT_SMILES_BASE = 'CC(=O)OC1=CC=CC=C1C(=O)O'
 DEFAULT_SIMILARITY_THRESHOLD = 0.7
-DEFAULT_PAUSE = 0.2
+DEFAULT_RATE = 10                   # KEGG requests per second, across all connections
 DEFAULT_TIMEOUT = 10
+DEFAULT_CONCURRENCY = 16
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 DEFAULT_NBITS = 2048
 DEFAULT_RADIUS = 2
 DEFAULT_INPUT_FILE = 'compounds.txt'
+DEFAULT_SCRAPE_FILE = 'scraped_kegg_ids.txt'
 DEFAULT_OUTPUT_FILE = 'resultados_similares_kegg.csv'
 DEFAULT_FAILED_FILE = 'failed_kegg_ids.csv'
-DEFAULT_IMAGE_FILE = 'mols_grid.png'
+DEFAULT_IMAGE_FILE = 'mols_grid.svg'
+DEFAULT_CACHE_FILE = 'kegg_cache.sqlite'
+DEFAULT_FP_CACHE = 'kegg_fps'
+CACHE_TTL = 30 * 24 * 3600          # Seconds a fetched MOL block stays valid
+NEGATIVE_CACHE_TTL = 24 * 3600      # Shorter, for KEGG IDs that really have no MOL block
+CACHE_BATCH = 500                   # IDs per cache lookup, below SQLite's bound-parameter limit
+
+# Returned by fetch_mol_block for transient failures, which are never cached
+FETCH_FAILED = object()
+
+# Well-formed KEGG entry ID (e.g. C00001)
+ID_RE = re.compile(r'[A-Z]\d{5}')
+# KEGG compound ID as it appears in raw page bytes, for the scraper
+SCRAPE_ID_RE = re.compile(rb'C\d{5}')
+
+# Sanitization steps Morgan connectivity hashing depends on (chirality cleanup is skipped)
+SANITIZE_OPS = Chem.SanitizeFlags.SANITIZE_ALL ^ Chem.SanitizeFlags.SANITIZE_CLEANUPCHIRALITY
+
+# Reusable Morgan fingerprint generator, set per process by init_worker
+GEN = None
 
 def setup_logger():
     logging.basicConfig(
@@ -31,49 +69,299 @@ def setup_logger():
         format='%(asctime)s %(levelname)s: %(message)s'
     )
 
+def auto_workers(n_tasks):
+    """Pick a process count for the fingerprint stage based on its size."""
+    if n_tasks < 32:
+        return 1
+    return min(mp.cpu_count(), max(4, n_tasks // 100))
+
 def read_kegg_ids(filename):
-    """Read KEGG compound IDs from a local file."""
+    """Read unique, well-formed KEGG compound IDs from a local file."""
     if not os.path.exists(filename):
         logging.error(f"File not found: {filename}")
         return []
     with open(filename, 'r') as f:
-        return [line.strip().split('\t')[0] for line in f if line.strip()]
+        # Drop KEGG database prefixes such as 'cpd:C00001'
+        ids = [line.strip().split('\t')[0].rpartition(':')[2] for line in f if line.strip()]
+    skipped = [x for x in ids if not ID_RE.fullmatch(x)]
+    if skipped:
+        logging.warning(f"Skipped {len(skipped)} malformed KEGG IDs in {filename}, e.g. {skipped[:5]}")
+        print(f"⚠️  Skipped {len(skipped)} malformed KEGG IDs (see log)")
+    # dict.fromkeys drops repeats while keeping file order
+    return list(dict.fromkeys(x for x in ids if ID_RE.fullmatch(x)))
+
+def open_cache(filename):
+    """Open (creating if needed) the on-disk KEGG MOL block cache."""
+    conn = sqlite3.connect(filename)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS cache (id TEXT PRIMARY KEY, mol_block TEXT, fetched REAL)')
+    return conn
+
+def read_cache(conn, kegg_ids):
+    """Return fresh cached MOL blocks by KEGG ID; cached misses map to None."""
+    now = time.time()
+    cached = {}
+    for i in range(0, len(kegg_ids), CACHE_BATCH):
+        batch = kegg_ids[i:i + CACHE_BATCH]
+        query = f"SELECT id, mol_block, fetched FROM cache WHERE id IN ({','.join('?' * len(batch))})"
+        for kegg_id, mol_block, fetched in conn.execute(query, batch):
+            ttl = CACHE_TTL if mol_block else NEGATIVE_CACHE_TTL
+            if now - fetched < ttl:
+                cached[kegg_id] = mol_block
+    return cached
 
-def get_smiles_from_kegg(kegg_id, pause, timeout):
-    """Fetch the SMILES string for a given KEGG ID using the KEGG REST API."""
+def write_cache(conn, mol_blocks):
+    """Store fetched MOL blocks (None for misses) in the on-disk cache, skipping transient failures."""
+    now = time.time()
+    conn.executemany(
+        'INSERT OR REPLACE INTO cache (id, mol_block, fetched) VALUES (?, ?, ?)',
+        [(kegg_id, mol_block, now) for kegg_id, mol_block in mol_blocks.items() if mol_block is not FETCH_FAILED]
+    )
+    conn.commit()
+
+class TokenBucket:
+    """Async token-bucket rate limiter shared by all requests of a run."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        # At least one token of capacity, or rates below 1/s could never send a request
+        self.capacity = max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a request may be sent."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.resume_at:
+                    await asyncio.sleep(self.resume_at - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def hold(self, delay):
+        """Stop handing out tokens for `delay` seconds (e.g. after a 429)."""
+        self.resume_at = max(self.resume_at, time.monotonic() + delay)
+
+def retry_delay(response, attempt):
+    """Seconds to wait before retrying, honouring a numeric Retry-After header."""
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return BACKOFF_FACTOR * 2 ** attempt
+
+async def fetch_mol_block(session, limiter, kegg_id, timeout):
+    """Fetch the MOL block for a KEGG ID: text, None if KEGG has none, FETCH_FAILED if transient."""
     url = f'https://rest.kegg.jp/get/{kegg_id}/mol'
+    for attempt in range(MAX_RETRIES + 1):
+        delay = BACKOFF_FACTOR * 2 ** attempt
+        await limiter.acquire()
+        try:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    return await response.text() or None
+                error = f"HTTP {response.status}"
+                delay = retry_delay(response, attempt)
+                if response.status in (429, 503):
+                    # KEGG is throttling us: back off globally, not just this request
+                    limiter.hold(delay)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            error = e
+        except aiohttp.ClientResponseError as e:
+            logging.warning(f"[{kegg_id}] Error fetching MOL block: {e}")
+            # Only 404 means KEGG has no MOL block; others (e.g. 403 when blocked) must not be cached
+            return None if e.status == 404 else FETCH_FAILED
+        except Exception as e:
+            logging.warning(f"[{kegg_id}] Error fetching MOL block: {e}")
+            return FETCH_FAILED
+        if attempt < MAX_RETRIES:
+            await asyncio.sleep(delay)
+    logging.warning(f"[{kegg_id}] Error fetching MOL block after {MAX_RETRIES + 1} attempts: {error}")
+    return FETCH_FAILED
+
+async def bounded_fetch(sem, session, limiter, kegg_id, timeout):
+    """Fetch a MOL block while holding one of the semaphore slots."""
+    async with sem:
+        return await fetch_mol_block(session, limiter, kegg_id, timeout)
+
+async def fetch_all_mol_blocks(kegg_ids, rate, timeout, concurrency):
+    """Fetch MOL blocks for all KEGG IDs over one pooled, rate-limited HTTP session."""
+    sem = asyncio.Semaphore(concurrency)
+    limiter = TokenBucket(rate)
+    # One keep-alive connection pool shared by every request
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        mol_blocks = await tqdm_asyncio.gather(
+            *[bounded_fetch(sem, session, limiter, kegg_id, timeout) for kegg_id in kegg_ids],
+            total=len(kegg_ids)
+        )
+    return dict(zip(kegg_ids, mol_blocks))
+
+def scrape_kegg_ids(urls, ruta_archivo, timeout, workers=8):
+    """Scrape KEGG compound IDs (Cxxxxx) from web pages and save them to a file."""
+    todos_identificadores = set()
+    with requests.Session() as sess:
+        def extraer_identificadores(url):
+            try:
+                response = sess.get(url, timeout=timeout)
+                response.raise_for_status()
+                # The IDs are a flat token pattern, so no HTML parsing is needed
+                return SCRAPE_ID_RE.findall(response.content)
+            except Exception as e:
+                logging.warning(f"Error scraping {url}: {e}")
+                return []
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for identificadores in executor.map(extraer_identificadores, urls):
+                todos_identificadores.update(m.decode() for m in identificadores)
+
+    # Guardar los identificadores en el archivo
+    with open(ruta_archivo, "w") as file:
+        for identificador in sorted(todos_identificadores):
+            file.write(identificador + "\n")
+
+    print("Identificadores guardados en:", ruta_archivo)
+
+def init_worker(radius, nbits):
+    """Create the Morgan fingerprint generator once per process."""
+    global GEN
+    GEN = rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=nbits)
+
+def sanitize_for_fingerprint(mol):
+    """Strip explicit Hs and partially sanitize an unsanitized molecule; None if invalid."""
+    if mol is None:
+        return None
     try:
-        time.sleep(pause)
-        response = requests.get(url, timeout=timeout)
-        response.raise_for_status()
-        mol = Chem.MolFromMolBlock(response.text)
-        if mol:
-            return Chem.MolToSmiles(mol)
-    except Exception as e:
-        logging.warning(f"[{kegg_id}] Error fetching SMILES: {e}")
-    return None
-
-def tanimoto_similarity_pair(smiles1, smiles2, nbits, radius):
-    """Calculate Tanimoto similarity between two SMILES strings."""
-    mol1 = Chem.MolFromSmiles(smiles1)
-    mol2 = Chem.MolFromSmiles(smiles2)
-    if mol1 and mol2:
-        fp1 = AllChem.GetMorganFingerprintAsBitVect(mol1, radius=radius, nBits=nbits)
-        fp2 = AllChem.GetMorganFingerprintAsBitVect(mol2, radius=radius, nBits=nbits)
-        return DataStructs.TanimotoSimilarity(fp1, fp2)
-    return 0.0
+        mol = Chem.RemoveHs(mol, sanitize=False)
+        Chem.SanitizeMol(mol, sanitizeOps=SANITIZE_OPS)
+    except ValueError:
+        return None
+    return mol
+
+def pack_fingerprint(mol):
+    """Return the Morgan fingerprint of a molecule as a packed uint64 row."""
+    return np.packbits(GEN.GetFingerprintAsNumPy(mol)).view(np.uint64)
+
+def bulk_tanimoto(base, matrix):
+    """Tanimoto similarity of a packed base fingerprint against each packed row."""
+    if njit is not None:
+        return bulk_tanimoto_jit(base, matrix, int(np.bitwise_count(base).sum()))
+    inter = np.bitwise_count(matrix & base).sum(axis=1)
+    union = np.bitwise_count(matrix).sum(axis=1) + np.bitwise_count(base).sum() - inter
+    return np.divide(inter, union, out=np.zeros(len(matrix)), where=union > 0)
+
+if njit is not None:
+    @intrinsic
+    def popcount64(typingctx, x):
+        """LLVM ctpop on a uint64 word (a single popcnt instruction where available)."""
+        sig = types.uint64(types.uint64)
+
+        def codegen(context, builder, signature, args):
+            return builder.ctpop(args[0])
+
+        return sig, codegen
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def bulk_tanimoto_jit(base, matrix, base_pop):
+        """Compiled Tanimoto kernel, parallel over fingerprint rows."""
+        out = np.empty(matrix.shape[0], np.float64)
+        for i in prange(matrix.shape[0]):
+            inter = 0
+            a = 0
+            for j in range(matrix.shape[1]):
+                inter += popcount64(matrix[i, j] & base[j])
+                a += popcount64(matrix[i, j])
+            union = a + base_pop - inter
+            out[i] = inter / union if union > 0 else 0.0
+        return out
 
 def evaluar_similitud(args):
-    """Wrapper for parallel similarity evaluation."""
-    kegg_id, smiles_base, threshold, pause, timeout, nbits, radius = args
-    if not kegg_id or not isinstance(kegg_id, str):
+    """Wrapper for parallel fingerprinting; returns (kegg_id, fp, mol_bytes), None-filled on failure."""
+    kegg_id, mol_block = args
+    if mol_block:
+        mol = sanitize_for_fingerprint(Chem.MolFromMolBlock(mol_block, sanitize=False))
+        if mol:
+            return (kegg_id, pack_fingerprint(mol), mol.ToBinary())
+    return (kegg_id, None, None)
+
+def fetch_mol_blocks(kegg_ids, args):
+    """Stage 1 (I/O-bound): MOL blocks by KEGG ID, fetching cache misses concurrently."""
+    cache = open_cache(args.cache)
+    mol_blocks = read_cache(cache, kegg_ids)
+    missing = [kegg_id for kegg_id in kegg_ids if kegg_id not in mol_blocks]
+    print(f"MOL blocks found in cache: {len(mol_blocks)}")
+    if missing:
+        print(f"Fetching {len(missing)} MOL blocks with up to {args.concurrency} concurrent requests...")
+        fetched = asyncio.run(
+            fetch_all_mol_blocks(missing, args.rate, args.timeout, args.concurrency)
+        )
+        write_cache(cache, fetched)
+        mol_blocks.update(
+            (kegg_id, None if mol_block is FETCH_FAILED else mol_block) for kegg_id, mol_block in fetched.items()
+        )
+    cache.close()
+    return mol_blocks
+
+def compute_fingerprints(pool_args, args):
+    """Stage 2 (CPU-bound): parallel fingerprinting of MOL blocks with progress bar."""
+    worker_kind = "threads" if args.threads else "processes"
+    suggested = auto_workers(len(pool_args))
+    if args.processes is None:
+        args.processes = suggested
+    elif args.processes > 2 * suggested:
+        print(f"⚠️  {args.processes} {worker_kind} is more than this workload needs (suggested: {suggested})")
+    print(f"Processing in parallel with {args.processes} {worker_kind}...")
+    # Batch tasks so each worker round-trip pickles a chunk, not a single molecule
+    chunksize = max(1, len(pool_args) // (4 * args.processes))
+    if args.threads:
+        # Threads share one RDKit import and need no pickling; same Pool API as processes
+        pool_cls = ThreadPool
+    else:
+        # forkserver children start clean instead of inheriting the parent's RDKit/asyncio state
+        pool_cls = (mp.get_context('forkserver') if sys.platform.startswith('linux') else mp.get_context()).Pool
+    with pool_cls(args.processes, initializer=init_worker, initargs=(args.radius, args.nbits)) as pool:
+        return list(tqdm(pool.imap_unordered(evaluar_similitud, pool_args, chunksize=chunksize), total=len(pool_args)))
+
+def fingerprint_matrix_files(prefix, radius, nbits):
+    """Paths of the saved fingerprint matrix and its KEGG ID index."""
+    stem = f"{prefix}_r{radius}_{nbits}"
+    return f"{stem}.npy", f"{stem}_ids.npy"
+
+def load_fingerprint_matrix(fps_file, ids_file, kegg_ids, nbits):
+    """Memory-map a saved fingerprint matrix if it was built for exactly these KEGG IDs."""
+    if not (os.path.exists(fps_file) and os.path.exists(ids_file)):
+        return None
+    try:
+        if np.load(ids_file).tolist() != kegg_ids:
+            return None
+        fps = np.load(fps_file, mmap_mode='r')
+    except (ValueError, OSError) as e:
+        # Truncated or otherwise unreadable file: rebuild it instead of crashing
+        logging.warning(f"Ignoring unreadable fingerprint matrix {fps_file}: {e}")
         return None
-    smiles = get_smiles_from_kegg(kegg_id, pause, timeout)
-    if smiles:
-        sim = tanimoto_similarity_pair(smiles_base, smiles, nbits, radius)
-        if sim >= threshold:
-            return (kegg_id, smiles, sim)
-    return None
+    if fps.dtype != np.uint64 or fps.shape != (len(kegg_ids), nbits // 64):
+        return None
+    return fps
+
+def atomic_save(filename, array):
+    """np.save to a temporary file, then move it into place in one step."""
+    tmp_file = f"{filename}.tmp"
+    with open(tmp_file, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_file, filename)
+
+def save_fingerprint_matrix(fps_file, ids_file, fps, kegg_ids):
+    """Save the packed fingerprint matrix and its KEGG ID index for later runs."""
+    atomic_save(fps_file, fps)
+    atomic_save(ids_file, np.array(kegg_ids))
 
 def main():
     setup_logger()
@@ -81,74 +369,140 @@ def main():
     parser = argparse.ArgumentParser(description="KEGG SMILES Similarity Miner")
     parser.add_argument('--smiles_base', default=DEFAULT_SMILES_BASE, help='Reference SMILES string')
     parser.add_argument('--threshold', type=float, default=DEFAULT_SIMILARITY_THRESHOLD, help='Similarity threshold')
-    parser.add_argument('--pause', type=float, default=DEFAULT_PAUSE, help='Pause between requests (seconds)')
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help='Maximum KEGG requests per second')
     parser.add_argument('--timeout', type=int, default=DEFAULT_TIMEOUT, help='Request timeout (seconds)')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Maximum concurrent KEGG requests')
     parser.add_argument('--nbits', type=int, default=DEFAULT_NBITS, help='Number of fingerprint bits')
     parser.add_argument('--radius', type=int, default=DEFAULT_RADIUS, help='Fingerprint radius')
     parser.add_argument('--input', default=DEFAULT_INPUT_FILE, help='Input KEGG IDs file')
+    parser.add_argument('--scrape', nargs='+', metavar='URL', help='Scrape KEGG IDs from these pages and analyze them instead of --input')
+    parser.add_argument('--scrape_output', default=DEFAULT_SCRAPE_FILE, help='File the scraped KEGG IDs are saved to')
     parser.add_argument('--output', default=DEFAULT_OUTPUT_FILE, help='Output CSV file')
     parser.add_argument('--failed', default=DEFAULT_FAILED_FILE, help='Failed KEGG IDs file')
-    parser.add_argument('--img', default=DEFAULT_IMAGE_FILE, help='Output image file')
-    parser.add_argument('--processes', type=int, default=mp.cpu_count(), help='Number of parallel processes')
+    parser.add_argument('--img', default=DEFAULT_IMAGE_FILE, help='Output SVG image file')
+    parser.add_argument('--render', action='store_true', help='Render the top molecules to --img')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_FILE, help='SQLite cache of fetched MOL blocks')
+    parser.add_argument('--fp_cache', default=DEFAULT_FP_CACHE, help='Prefix of the saved fingerprint matrix (.npy)')
+    parser.add_argument('--processes', type=int, default=None, help='Number of parallel processes (default: sized to the workload)')
+    parser.add_argument('--threads', action='store_true', help='Use threads instead of processes (no fork or pickling overhead)')
     args = parser.parse_args()
 
+    # Optionally build the input file from web pages (never over the --input data file)
+    if args.scrape:
+        scrape_kegg_ids(args.scrape, args.scrape_output, args.timeout)
+        args.input = args.scrape_output
+
     # Read KEGG IDs
     kegg_ids = read_kegg_ids(args.input)
     if not kegg_ids:
         print("No KEGG IDs found.")
         return
 
+    if args.nbits % 64:
+        print("--nbits must be a multiple of 64.")
+        return
+
+    if args.rate <= 0:
+        print("--rate must be greater than 0.")
+        return
+
+    if args.concurrency < 1:
+        print("--concurrency must be at least 1.")
+        return
+
+    if args.processes is not None and args.processes < 1:
+        print("--processes must be at least 1.")
+        return
+
     print(f"Total KEGG compounds to analyze: {len(kegg_ids)}")
 
-    # Prepare pool arguments
-    pool_args = [
-        (kegg_id, args.smiles_base, args.threshold, args.pause, args.timeout, args.nbits, args.radius)
-        for kegg_id in kegg_ids
-    ]
+    # Reference fingerprint is computed once, not per KEGG ID
+    smiles_params = Chem.SmilesParserParams()
+    smiles_params.sanitize = False
+    mol_base = sanitize_for_fingerprint(Chem.MolFromSmiles(args.smiles_base, smiles_params))
+    if mol_base is None:
+        print(f"Invalid reference SMILES: {args.smiles_base}")
+        return
+    init_worker(args.radius, args.nbits)
+    fp_base = pack_fingerprint(mol_base)
+
+    # Reuse the saved fingerprint matrix when it covers exactly these KEGG IDs
+    fps_file, ids_file = fingerprint_matrix_files(args.fp_cache, args.radius, args.nbits)
+    fps = load_fingerprint_matrix(fps_file, ids_file, kegg_ids, args.nbits)
+    fresh = fps is None
+    if fresh:
+        fps = np.zeros((len(kegg_ids), args.nbits // 64), dtype=np.uint64)
+        todo = kegg_ids
+    else:
+        # All-zero rows are compounds that could not be fetched or parsed last time
+        todo = [kegg_ids[i] for i in np.flatnonzero(~fps.any(axis=1))]
+        print(f"Reusing fingerprint matrix {fps_file} ({len(todo)} missing rows to retry)")
 
-    # Parallel processing with progress bar
-    print(f"Processing in parallel with {args.processes} processes...")
+    mol_bytes_by_id = {}
+    if todo:
+        mol_blocks = fetch_mol_blocks(todo, args)
+        pool_args = [(kegg_id, mol_blocks[kegg_id]) for kegg_id in todo if mol_blocks[kegg_id]]
+        if pool_args:
+            row = {kegg_id: i for i, kegg_id in enumerate(kegg_ids)}
+            fps = np.array(fps)  # Writable copy if it came from the read-only memmap
+            for kegg_id, fp, mol_bytes in compute_fingerprints(pool_args, args):
+                if fp is not None:
+                    fps[row[kegg_id]] = fp
+                    mol_bytes_by_id[kegg_id] = mol_bytes
+        # Never write a loaded matrix back unless this run filled rows (it may be the memmap itself)
+        if fresh or mol_bytes_by_id:
+            save_fingerprint_matrix(fps_file, ids_file, fps, kegg_ids)
+
+    # Vectorized Tanimoto over the (N, nbits/64) fingerprint matrix
+    sims = bulk_tanimoto(fp_base, fps)
+    accepted = fps.any(axis=1) & (sims >= args.threshold)
+    failed_ids = [kegg_ids[i] for i in np.flatnonzero(~accepted)]
+    hit_ids = [kegg_ids[i] for i in np.flatnonzero(accepted)]
+
+    # Molecules of accepted matches come from this run's workers, or the MOL block cache
+    reparse = [kegg_id for kegg_id in hit_ids if kegg_id not in mol_bytes_by_id]
+    mol_blocks = fetch_mol_blocks(reparse, args) if reparse else {}
     resultados = []
-    failed_ids = []
-    with mp.Pool(args.processes) as pool:
-        for res, kegg_id in zip(tqdm(pool.imap_unordered(evaluar_similitud, pool_args), total=len(kegg_ids)), kegg_ids):
-            if res is not None:
-                resultados.append(res)
-            else:
-                failed_ids.append(kegg_id)
+    for i in np.flatnonzero(accepted):
+        kegg_id = kegg_ids[i]
+        if kegg_id in mol_bytes_by_id:
+            mol = Chem.Mol(mol_bytes_by_id[kegg_id])
+        elif mol_blocks.get(kegg_id):
+            mol = sanitize_for_fingerprint(Chem.MolFromMolBlock(mol_blocks[kegg_id], sanitize=False))
+        else:
+            mol = None
+        if mol is None:
+            failed_ids.append(kegg_id)
+            continue
+        # Canonical SMILES only for accepted matches
+        resultados.append((kegg_id, Chem.MolToSmiles(mol), float(sims[i]), mol))
 
     # Sort results by similarity descending
     resultados.sort(key=lambda x: x[2], reverse=True)
 
     # Save results to CSV
-    with open(args.output, "w", newline="") as f:
+    with open(args.output, "w", newline="", buffering=1 << 20) as f:
         writer = csv.writer(f)
         writer.writerow(["KEGG_ID", "SMILES", "Tanimoto_Similarity"])
-        writer.writerows(resultados)
+        writer.writerows(r[:3] for r in resultados)
     print(f"✅ Total similar compounds found: {len(resultados)}")
     print(f"📁 Results saved to: {args.output}")
 
     # Save failed IDs
     if failed_ids:
-        with open(args.failed, "w", newline="") as f:
+        with open(args.failed, "w", newline="", buffering=1 << 20) as f:
             writer = csv.writer(f)
             writer.writerow(["KEGG_ID"])
-            for fid in failed_ids:
-                writer.writerow([fid])
+            writer.writerows([fid] for fid in failed_ids)
         print(f"⚠️  Failed KEGG IDs saved to: {args.failed}")
 
-    # Show/save molecular images
-    if resultados:
-        mols = [Chem.MolFromSmiles(r[1]) for r in resultados[:6]]
-        img = Draw.MolsToGridImage(mols, molsPerRow=3, subImgSize=(200, 200))
-        img.save(args.img)
+    # Save molecular images (vector SVG, only on request)
+    if args.render and resultados:
+        mols = [r[3] for r in resultados[:6]]
+        svg = Draw.MolsToGridImage(mols, molsPerRow=3, subImgSize=(200, 200), useSVG=True)
+        with open(args.img, "w") as f:
+            f.write(svg)
         print(f"🖼️  Top molecules grid image saved as: {args.img}")
 
 if __name__ == '__main__':
     main()
-# Guardar los identificadores en el archivo
-with open(ruta_archivo, "w") as file:
-    for identificador in sorted(todos_identificadores):
-        file.write(identificador + "\n")
-
-print("Identificadores guardados en:", ruta_archivo)